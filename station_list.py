@@ -23,19 +23,60 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
 import gzip
-import io
-import json
+import os
+import re
 import ssl
 import sys
 from urllib.error import HTTPError, URLError
 from urllib.request import Request, urlopen
 
-from lxml import html  # nosec
+import orjson
+
+try:
+    import brotli
+except ImportError:
+    brotli = None  # pylint: disable=invalid-name
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # pylint: disable=invalid-name
 
 VERSION = '0.1'
 MOBI_URL = 'https://www.mobibikes.ca/en/map'
-
-KNOWN_STATIONS = [
+DRUPAL_SETTINGS_PREFIX = b'jQuery.extend(Drupal.settings, '
+JSON_TOKEN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[{}]', re.DOTALL)
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'mobi-stations')
+CACHE_BODY = os.path.join(CACHE_DIR, 'map.html')
+CACHE_VALIDATORS = os.path.join(CACHE_DIR, 'map.json')
+
+# Disable all certificate checking because the Mobi TLS config is garbage.
+SSL_CONTEXT = ssl.create_default_context()
+SSL_CONTEXT.check_hostname = False
+SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+
+
+def zstd_decompress(body):
+    """Decompress a zstd body, which may hold several frames without recorded sizes."""
+    decompressor = zstandard.ZstdDecompressor()
+    chunks = []
+    while body:
+        frame = decompressor.decompressobj()
+        chunks.append(frame.decompress(body))
+        if not frame.eof:
+            raise ValueError("Truncated zstd response")
+        body = frame.unused_data
+    return b''.join(chunks)
+
+
+# Content encodings we can decode, keyed by their Accept-Encoding token.
+DECOMPRESSORS = {}
+if zstandard:
+    DECOMPRESSORS['zstd'] = zstd_decompress
+if brotli:
+    DECOMPRESSORS['br'] = brotli.decompress
+DECOMPRESSORS['gzip'] = gzip.decompress
+
+KNOWN_STATIONS = frozenset([
     "0001",
     "0002",
     "0004",
@@ -238,14 +279,14 @@ KNOWN_STATIONS = [
     "0298",
     "0300",
     "0305",
-]
-KNOWN_DISUSED_STATIONS = [
-]
+])
+KNOWN_DISUSED_STATIONS = frozenset([
+])
 
 # pylint: disable=invalid-name
 stations = {}
-new_stations = []
-all_stations = []
+new_stations = set()
+all_stations = set()
 
 
 def osm_link(latitude, longitude):
@@ -254,41 +295,43 @@ def osm_link(latitude, longitude):
     return "https://www.openstreetmap.org/?mlat=%s&mlon=%s#map=%s/%s/%s" % (latitude, longitude, zoom_level, latitude, longitude)
 
 
-def print_station(ref, data):
-    """Output all station metadata."""
-    print("%s:" % ref)
-    print("  name=%s" % data["name"])
-    print("  capacity=%s" % data["capacity"])
+def format_station(ref, data):
+    """Return all station metadata as a block of text."""
+    lines = ["%s:" % ref,
+             "  name=%s" % data["name"],
+             "  capacity=%s" % data["capacity"]]
     if data["disused"]:
-        print("  disused=yes")
-    print("  latitude=%s" % data["latitude"])
-    print("  longitude=%s" % data["longitude"])
-    print("  %s" % osm_link(data["latitude"], data["longitude"]))
+        lines.append("  disused=yes")
+    lines.append("  latitude=%s" % data["latitude"])
+    lines.append("  longitude=%s" % data["longitude"])
+    lines.append("  %s" % osm_link(data["latitude"], data["longitude"]))
+    return "\n".join(lines)
 
 
 def print_stations(verbose, quiet):
     """Output all stations with their metadata along with deleted stations."""
+    output = []
     need_newline = False
-    for ref in sorted(stations):
-        data = stations[ref]
-        if verbose or ref in new_stations:
-            print_station(ref, data)
-            need_newline = True
+    for ref in sorted(stations if verbose else new_stations):
+        output.append(format_station(ref, stations[ref]))
+        need_newline = True
 
-    if len(KNOWN_STATIONS) != len(all_stations):
+    removed_stations = KNOWN_STATIONS - all_stations
+    if removed_stations:
         if need_newline:
-            print()
-            need_newline = False
+            output.append("")
 
-        for ref in sorted(KNOWN_STATIONS):
-            if ref not in all_stations:
-                print("%s is no longer advertised" % ref)
-                need_newline = True
+        for ref in sorted(removed_stations):
+            output.append("%s is no longer advertised" % ref)
+        need_newline = True
 
     if not quiet:
         if need_newline:
-            print()
-        print(sorted(all_stations))
+            output.append("")
+        output.append(str(sorted(all_stations)))
+
+    if output:
+        print("\n".join(output))
 
 
 def print_stats(quiet):
@@ -310,13 +353,16 @@ def process_markers(markers):
     """Parse the markers extracted from the config of the Mobi homepage."""
     for marker in markers:
         if not marker["poi"]:
-            # Temporary station
-            ref = '0000'
-            name = marker["title"]
-            if marker["title"][0] != '-' and marker["title"][4] == ' ':
+            title = marker["title"]
+            head, separator, tail = title.partition(' ')
+            if separator and len(head) == 4 and head[0] != '-':
                 # Permanent station
-                ref = marker["title"][0:4]
-                name = marker["title"][5:]
+                ref = head
+                name = tail
+            else:
+                # Temporary station
+                ref = '0000'
+                name = title
 
             capacity = marker["total_slots"]
             latitude = marker["latitude"]
@@ -333,45 +379,113 @@ def process_markers(markers):
             if ref in ("0000", "0997", "1000"):  # leave temporary stations out
                 continue
 
-            all_stations.append(ref)
+            all_stations.add(ref)
             if not disused and ref not in KNOWN_STATIONS:
-                new_stations.append(ref)
+                new_stations.add(ref)
             elif disused and ref not in KNOWN_DISUSED_STATIONS:
-                new_stations.append(ref)
+                new_stations.add(ref)
 
 
-def process_script(script):
+def process_script(text):
     """Extract metadata out of the Drupal settings variable."""
-    text = script.replace('jQuery.extend(Drupal.settings, ', '')
-    text = text.replace('});', '}')
-    data = json.loads(text)
+    data = orjson.loads(text)
     process_markers(data['markers'])
 
 
+def find_json_end(page, start):
+    """Return the offset just past the JSON object starting at the given offset."""
+    depth = 0
+    for token in JSON_TOKEN.finditer(page, start):
+        if token.group() == b'{':
+            depth += 1
+        elif token.group() == b'}':
+            depth -= 1
+            if depth == 0:
+                return token.end()
+    raise ValueError("Unterminated Drupal settings object")
+
+
 def process_html(page):
     """Extract the Drupal config out of the Mobi homepage."""
-    tree = html.fromstring(page)
-    scripts = tree.xpath('//script/text()')
-    for script in scripts:
-        if 'Drupal.settings' in script:
-            process_script(script)
+    start = page.find(DRUPAL_SETTINGS_PREFIX)
+    if start == -1:
+        return
+    start += len(DRUPAL_SETTINGS_PREFIX)
+    # Hand orjson a view of the settings object rather than a copy of it.
+    process_script(memoryview(page)[start:find_json_end(page, start)])
 
 
-def download_html(url):
-    """Download the HTML from the Mobi homepage in an efficient way."""
-    # Disable all certificate checking because the Mobi TLS config is garbage.
-    context = ssl.create_default_context()
-    context.check_hostname = False
-    context.verify_mode = ssl.CERT_NONE
+def read_cache(url):
+    """Return the validators and body of the last successful download of a URL, if any."""
+    try:
+        with open(CACHE_VALIDATORS, 'rb') as f:
+            validators = orjson.loads(f.read())
+        if validators.get('url') != url:
+            return ({}, None)
+        with open(CACHE_BODY, 'rb') as f:
+            return (validators, f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return ({}, None)
+
+
+def replace_file(path, contents):
+    """Atomically replace a file so that readers never see a partial write."""
+    temp_path = '%s.%s.tmp' % (path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(contents)
+        os.replace(temp_path, path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
 
-    request = Request(url, headers={'Accept-encoding': 'gzip'})
-    response = urlopen(request, context=context)  # nosec
 
-    if response.info().get('Content-Encoding') == 'gzip':
-        buf = io.BytesIO(response.read())
-        response = gzip.GzipFile(fileobj=buf)
+def write_cache(validators, body):
+    """Save the downloaded page so that the next run can revalidate it."""
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Write the body first so that validators never describe a missing page.
+        replace_file(CACHE_BODY, body)
+        replace_file(CACHE_VALIDATORS, orjson.dumps(validators))
+    except OSError:
+        pass  # the cache is only an optimization
 
-    return response.read()
+
+def download_html(url):
+    """Download the HTML from the Mobi homepage in an efficient way."""
+    headers = {'Accept-encoding': ', '.join(DECOMPRESSORS)}
+    validators, cached_body = read_cache(url)
+    if cached_body is not None:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    request = Request(url, headers=headers)
+    try:
+        response = urlopen(request, context=SSL_CONTEXT)  # nosec
+    except HTTPError as e:
+        if cached_body is None:
+            raise
+        if e.code != 304:
+            print("Warning: using cached map after download error: %s" % e, file=sys.stderr)
+        return cached_body
+    except URLError as e:
+        if cached_body is None:
+            raise
+        print("Warning: using cached map after download error: %s" % e, file=sys.stderr)
+        return cached_body
+
+    body = response.read()
+    encoding = response.info().get('Content-Encoding')
+    if encoding in DECOMPRESSORS:
+        body = DECOMPRESSORS[encoding](body)
+
+    write_cache({'url': url,
+                 'etag': response.info().get('ETag'),
+                 'last_modified': response.info().get('Last-Modified')}, body)
+    return body
 
 
 def main():